@@ -6,25 +6,89 @@ A股日线K线数据获取脚本
 
 import os
 import sys
+import gzip
+import json
 import time
+import shutil
+import sqlite3
+import asyncio
+import threading
 import argparse
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import List, Optional, Dict
 
+import aiohttp
 import akshare as ak
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from tqdm.asyncio import tqdm_asyncio
 
 
 # ==================== 配置模块 ====================
 
 DATA_DIR = "data"
-KLINE_DIR = "data/kline_daily"
+KLINE_DIR = "data/kline_daily"  # 按年份分区的数据集: {KLINE_DIR}/year={year}/part-*.parquet
 STOCK_LIST_FILE = "data/stock_list.parquet"
+STOCK_LIST_TTL = 24 * 3600  # 股票列表文件的有效期（秒），有效期内不再重新获取
+CHECKPOINT_FILE = "data/checkpoint.db"  # 断点续传记录（sqlite）
+CHECKPOINT_INTERVAL = 500  # 每完成多少只股票落盘一次数据并记录断点
 DEFAULT_START_DATE = "19910101"  # 日线数据可以追溯到1991年
 MAX_RETRIES = 3
-REQUEST_DELAY = 0.5  # 请求间隔（秒）
+REQUEST_DELAY = 0.5  # 重试退避的基准间隔（秒）
+REQUEST_RATE = 15  # 每个接口每秒最多发出的请求数（令牌桶速率）
+REQUEST_BURST = 15  # 令牌桶容量，允许的瞬时突发请求数
+MAX_CONCURRENCY = 16  # 同时下载的股票数量
+REQUEST_TIMEOUT = 30  # 单次请求超时（秒）
+KEEPALIVE_TIMEOUT = 60  # 空闲连接保持时间（秒），复用TCP/TLS连接
+DNS_CACHE_TTL = 3600  # DNS解析结果缓存时间（秒）
+COMPACT_THRESHOLD = 20  # 单个年份分区文件数超过该值时合并
+FLUSH_ROWS = 1_000_000  # 内存中累积多少行后写出一批行组
+ROW_GROUP_SIZE = 128_000  # Parquet行组大小
+
+KLINE_COLUMNS = ['date', 'symbol', 'open', 'high', 'low', 'close',
+                 'volume', 'amount', 'adj_factor']
+KLINE_SCHEMA = pa.schema([
+    ('date', pa.timestamp('us')),
+    ('symbol', pa.string()),
+    ('open', pa.float64()),
+    ('high', pa.float64()),
+    ('low', pa.float64()),
+    ('close', pa.float64()),
+    ('volume', pa.int64()),
+    ('amount', pa.float64()),
+    ('adj_factor', pa.float64()),
+])
+KLINE_PARTITIONING = ds.partitioning(pa.schema([('year', pa.int32())]), flavor='hive')
+# 所有Parquet文件的写入参数：zstd 3级压缩、1MB数据页；symbol 在每个文件中只有几千种取值，
+# date 在一个年份分区中只有约250种取值，对这两列使用字典编码（文件中不存在的列会被忽略）
+PARQUET_WRITE_OPTIONS = dict(compression='zstd', compression_level=3,
+                             use_dictionary=['symbol', 'date'], data_page_size=1 << 20,
+                             write_statistics=True)
+
+# 所有请求共用的请求头
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept-Encoding": "gzip, deflate",
+}
+
+# 东方财富日线接口（ak.stock_zh_a_hist 的底层接口）
+EM_KLINE_URL = "https://push2his.eastmoney.com/api/qt/stock/kline/get"
+EM_ADJUST_CODES = {"": "0", "qfq": "1", "hfq": "2"}
+EM_KLINE_COLUMNS = ['日期', '开盘', '收盘', '最高', '最低', '成交量', '成交额',
+                    '振幅', '涨跌幅', '涨跌额', '换手率']
+
+# 新浪前复权因子接口（ak.stock_zh_a_daily(adjust="qfq-factor") 的底层接口）
+SINA_QFQ_FACTOR_URL = "https://finance.sina.com.cn/realstock/company/{}/qfq.js"
+
+# 不复权日线原始响应的磁盘缓存（每只股票一个文件，只保存到昨天为止的历史数据）
+CACHE_DIR = ".cache/eastmoney"
+CACHE_ENABLED = True
 
 
 # ==================== 工具函数 ====================
@@ -33,6 +97,7 @@ def ensure_directories():
     """确保数据目录存在"""
     Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
     Path(KLINE_DIR).mkdir(parents=True, exist_ok=True)
+    Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
     print(f"数据目录已创建: {DATA_DIR}, {KLINE_DIR}")
 
 
@@ -41,9 +106,7 @@ def retry_on_error(func, max_retries=MAX_RETRIES, delay=REQUEST_DELAY):
     def wrapper(*args, **kwargs):
         for attempt in range(max_retries):
             try:
-                result = func(*args, **kwargs)
-                time.sleep(delay)  # 请求间隔
-                return result
+                return func(*args, **kwargs)
             except Exception as e:
                 if attempt == max_retries - 1:
                     raise e
@@ -53,10 +116,236 @@ def retry_on_error(func, max_retries=MAX_RETRIES, delay=REQUEST_DELAY):
     return wrapper
 
 
+def to_date_keys(dates) -> np.ndarray:
+    """把日期转换为 int32 的 yyyymmdd 整数键
+
+    合并、排序复权因子时用它代替 datetime64（8字节）或 Python date 对象作为键。
+    """
+    dates = pd.DatetimeIndex(dates)
+    return (dates.year * 10000 + dates.month * 100 + dates.day).to_numpy(dtype=np.int32)
+
+
+def async_retry_on_error(func, max_retries=MAX_RETRIES, delay=REQUEST_DELAY):
+    """异步错误重试装饰器"""
+    async def wrapper(*args, **kwargs):
+        for attempt in range(max_retries):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if attempt == max_retries - 1:
+                    raise e
+                print(f"  尝试 {attempt + 1}/{max_retries} 失败: {str(e)}, 重试中...")
+                await asyncio.sleep(delay * (attempt + 1))  # 递增延迟
+        return None
+    return wrapper
+
+
+class TokenBucket:
+    """异步令牌桶限速器
+
+    令牌以 rate 个/秒的速度补充，最多积累 capacity 个；每次请求前 acquire() 取走一个
+    令牌，令牌不足时等待。服务器空闲时可以连续发出 capacity 个请求，长期速率不超过 rate。
+    只在事件循环线程中使用，检查和扣减令牌之间没有 await，无需加锁。
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    async def acquire(self):
+        """取走一个令牌，令牌不足时等待补充"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# 东方财富和新浪分别限速
+EM_RATE_LIMITER = TokenBucket(REQUEST_RATE, REQUEST_BURST)
+SINA_RATE_LIMITER = TokenBucket(REQUEST_RATE, REQUEST_BURST)
+
+
+# ==================== 请求缓存模块 ====================
+
+def get_cache_path(symbol: str) -> str:
+    """返回股票不复权日线缓存文件的路径"""
+    return os.path.join(CACHE_DIR, f"{symbol}.json.gz")
+
+
+def kline_date(kline: str) -> str:
+    """返回K线原始字符串的日期 (YYYYMMDD)"""
+    return kline[:10].replace('-', '')
+
+
+def next_date(date: str) -> str:
+    """返回 YYYYMMDD 日期的下一天"""
+    return (datetime.strptime(date, '%Y%m%d') + timedelta(days=1)).strftime('%Y%m%d')
+
+
+def load_cached_klines(symbol: str) -> Optional[Dict]:
+    """读取股票的不复权日线缓存
+
+    每只股票一个缓存文件，记录已完整下载过的区间 [start, end] 及其中的K线原始字符串。
+    end 不晚于写入当天的前一天，不复权的历史K线不会再变化，缓存永久有效。
+
+    Returns:
+        {"start": YYYYMMDD, "end": YYYYMMDD, "klines": [...]}，缓存不存在或损坏时返回 None
+    """
+    cache_path = get_cache_path(symbol)
+    if not CACHE_ENABLED or not os.path.exists(cache_path):
+        return None
+
+    try:
+        with gzip.open(cache_path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cached_klines(symbol: str, start_date: str, end_date: str, klines: List[str]):
+    """写入股票的不复权日线缓存（先写临时文件再替换，避免中断时留下不完整的缓存）"""
+    if not CACHE_ENABLED:
+        return
+
+    cache_path = get_cache_path(symbol)
+    tmp_path = f"{cache_path}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump({"start": start_date, "end": end_date, "klines": klines}, f)
+    os.replace(tmp_path, cache_path)
+
+
+def prune_cache():
+    """删除旧版按 (symbol, adjust, start_date, end_date) 命名的缓存文件和中断遗留的临时文件"""
+    stale_files = list(Path(CACHE_DIR).glob("*.json")) + list(Path(CACHE_DIR).glob("*.tmp"))
+    for file_path in stale_files:
+        file_path.unlink()
+    if stale_files:
+        print(f"已清理 {len(stale_files)} 个过期的缓存文件")
+
+
+# ==================== 行情请求模块 ====================
+
+def create_session() -> aiohttp.ClientSession:
+    """创建整个运行期间共用的 aiohttp 会话
+
+    连接池按主机限制连接数并长时间保持空闲连接，东方财富和新浪两个主机的
+    TCP/TLS 连接在所有请求之间复用，DNS 解析结果也会被缓存。
+    """
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENCY * 2,
+        limit_per_host=MAX_CONCURRENCY,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=DNS_CACHE_TTL,
+    )
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HTTP_HEADERS)
+
+
+@async_retry_on_error
+async def request_hist_klines(session: aiohttp.ClientSession, params: Dict[str, str]) -> List[str]:
+    """请求东方财富日线接口，返回K线原始字符串列表"""
+    await EM_RATE_LIMITER.acquire()
+    async with session.get(EM_KLINE_URL, params=params) as resp:
+        resp.raise_for_status()
+        data_json = await resp.json(content_type=None)
+
+    return (data_json.get("data") or {}).get("klines") or []
+
+
+async def request_hist_klines_cached(session: aiohttp.ClientSession, symbol: str,
+                                     params: Dict[str, str]) -> List[str]:
+    """请求不复权日线，已缓存的区间直接从缓存读取，只请求缓存之后的部分
+
+    缓存区间与请求区间相接时在其末尾追加新数据；只缓存非空响应中截至昨天的K线
+    （今天的K线在盘中还会变化），空响应不写入缓存，避免一次异常响应永久遮蔽数据。
+    缓存文件的 gzip 解压/压缩和 JSON 编解码交给线程池执行，不阻塞事件循环中的其他下载。
+    """
+    loop = asyncio.get_running_loop()
+    start_date, end_date = params["beg"], params["end"]
+    cache = await loop.run_in_executor(None, load_cached_klines, symbol)
+
+    if cache is not None and cache["start"] <= start_date <= next_date(cache["end"]):
+        cached = [k for k in cache["klines"] if start_date <= kline_date(k) <= end_date]
+        if end_date <= cache["end"]:
+            return cached
+        new_klines = await request_hist_klines(session, dict(params, beg=next_date(cache["end"])))
+        base_start, base_klines = cache["start"], cache["klines"]
+    else:
+        cached = []
+        new_klines = await request_hist_klines(session, params)
+        base_start, base_klines = start_date, []
+
+    # 新区间需覆盖原有缓存区间，才替换缓存
+    cache_end = min(end_date, (datetime.now() - timedelta(days=1)).strftime('%Y%m%d'))
+    covers_cache = cache is None or (base_start <= cache["start"] and cache_end >= cache["end"])
+    if new_klines and covers_cache and cache_end >= base_start:
+        await loop.run_in_executor(
+            None, save_cached_klines, symbol, base_start, cache_end,
+            base_klines + [k for k in new_klines if kline_date(k) <= cache_end])
+
+    return cached + new_klines
+
+
+async def fetch_hist(session: aiohttp.ClientSession, symbol: str, start_date: str,
+                     end_date: str, adjust: str = "") -> pd.DataFrame:
+    """异步获取东方财富日线行情，等价于 ak.stock_zh_a_hist(period="daily")
+
+    Args:
+        session: 共享的 aiohttp 会话
+        symbol: 股票代码
+        start_date: 开始日期 (YYYYMMDD)
+        end_date: 结束日期 (YYYYMMDD)
+        adjust: 复权类型 ('' 不复权, 'qfq' 前复权, 'hfq' 后复权)
+
+    Returns:
+        与 ak.stock_zh_a_hist 列名一致的DataFrame，无数据时返回空DataFrame
+    """
+    params = {
+        "fields1": "f1,f2,f3,f4,f5,f6",
+        "fields2": "f51,f52,f53,f54,f55,f56,f57,f58,f59,f60,f61",
+        "ut": "7eea3edcaed734bea9cbfc24409ed989",
+        "klt": "101",  # 日线
+        "fqt": EM_ADJUST_CODES[adjust],
+        "secid": f"{1 if symbol.startswith('6') else 0}.{symbol}",  # 1: 上交所, 0: 深交所
+        "beg": start_date,
+        "end": end_date,
+    }
+
+    # 不复权数据优先读取磁盘缓存；复权数据随除权除息变化，不缓存
+    if adjust == "" and CACHE_ENABLED:
+        klines = await request_hist_klines_cached(session, symbol, params)
+    else:
+        klines = await request_hist_klines(session, params)
+
+    if not klines:
+        return pd.DataFrame()
+
+    df = pd.DataFrame([item.split(",") for item in klines], columns=EM_KLINE_COLUMNS)
+    numeric_columns = EM_KLINE_COLUMNS[1:]
+    df[numeric_columns] = df[numeric_columns].apply(pd.to_numeric, errors='coerce')
+    return df
+
+
 # ==================== 股票列表获取模块 ====================
 
 def get_stock_list() -> pd.DataFrame:
-    """获取所有A股股票代码列表"""
+    """获取所有A股股票代码列表
+
+    STOCK_LIST_FILE 在 STOCK_LIST_TTL 内写入过时直接读取，不再请求行情快照接口。
+    """
+    if CACHE_ENABLED and os.path.exists(STOCK_LIST_FILE):
+        age = time.time() - os.path.getmtime(STOCK_LIST_FILE)
+        if age < STOCK_LIST_TTL:
+            stock_list = pd.read_parquet(STOCK_LIST_FILE)
+            print(f"使用 {age / 3600:.1f} 小时前保存的股票列表: {STOCK_LIST_FILE}, 共 {len(stock_list)} 只股票")
+            return stock_list
+
     print("正在获取A股股票列表...")
 
     @retry_on_error
@@ -72,7 +361,8 @@ def get_stock_list() -> pd.DataFrame:
     stock_list.columns = ['symbol', 'name']
 
     # 保存到文件
-    stock_list.to_parquet(STOCK_LIST_FILE, index=False)
+    pq.write_table(pa.Table.from_pandas(stock_list, preserve_index=False), STOCK_LIST_FILE,
+                   **PARQUET_WRITE_OPTIONS)
     print(f"股票列表已保存: {STOCK_LIST_FILE}, 共 {len(stock_list)} 只股票")
 
     return stock_list
@@ -80,47 +370,86 @@ def get_stock_list() -> pd.DataFrame:
 
 # ==================== 复权因子获取模块 ====================
 
-def fetch_adj_factor(symbol: str, start_date: str, end_date: str) -> Optional[pd.DataFrame]:
+def to_sina_symbol(symbol: str) -> str:
+    """股票代码转换为新浪格式，例如 600000 -> sh600000
+
+    北交所代码以 92、4、8 开头（92 开头的新代码优先于沪市 B 股的 900 判断），
+    沪市为 6 开头的 A 股和 900 开头的 B 股，其余为深市。
+    """
+    if symbol.startswith(('92', '4', '8')):
+        return f"bj{symbol}"
+    if symbol.startswith(('6', '900')):
+        return f"sh{symbol}"
+    return f"sz{symbol}"
+
+
+@async_retry_on_error
+async def fetch_adj_factor(session: aiohttp.ClientSession, symbol: str) -> Optional[pd.DataFrame]:
     """获取复权因子
 
+    新浪只返回除权除息日的前复权因子序列（一次请求，数据量很小），
+    每个因子从其日期起生效，直到下一个除权日。
+
     Args:
+        session: 共享的 aiohttp 会话
         symbol: 股票代码
-        start_date: 开始日期 (YYYYMMDD)
-        end_date: 结束日期 (YYYYMMDD)
 
     Returns:
-        包含日期和复权因子的DataFrame，列名为 ['date', 'adj_factor']
+        按日期升序的DataFrame，列名为 ['date', 'adj_factor']
     """
-    @retry_on_error
-    def fetch():
-        # 获取前复权和不复权数据来计算复权因子
-        df_qfq = ak.stock_zh_a_hist(symbol=symbol, period="daily",
-                                     start_date=start_date, end_date=end_date,
-                                     adjust="qfq")  # 前复权
-        df_raw = ak.stock_zh_a_hist(symbol=symbol, period="daily",
-                                     start_date=start_date, end_date=end_date,
-                                     adjust="")  # 不复权
-
-        if df_qfq is None or df_raw is None or df_qfq.empty or df_raw.empty:
-            return None
+    url = SINA_QFQ_FACTOR_URL.format(to_sina_symbol(symbol))
+    await SINA_RATE_LIMITER.acquire()
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        text = await resp.text(errors='ignore')
+
+    # 响应格式: var xxx={"total":N,"data":[{"d":"2024-06-14","f":"1.0000"},...]}
+    # 新浪出错时可能返回错误信息或HTML页面，解析失败按无因子处理（调用方使用默认值1.0），
+    # 不让异常经 asyncio.gather 传出而丢掉已获取的K线
+    try:
+        data = json.loads(text.split("=", 1)[1].split("\n")[0]).get("data")
+    except (IndexError, ValueError, AttributeError):
+        return None
+    if not data:
+        return None
+
+    # 新浪前复权价格 = 不复权价格 / qfq_factor，因此 adj_factor = 1 / qfq_factor
+    df_factor = pd.DataFrame(data)
+    df_adj = pd.DataFrame({
+        'date': pd.to_datetime(df_factor['d']),
+        'adj_factor': 1.0 / df_factor['f'].astype(float)
+    })
 
-        # 计算复权因子 = 前复权价格 / 不复权价格
-        df_adj = pd.DataFrame({
-            'date': pd.to_datetime(df_raw['日期']),
-            'adj_factor': df_qfq['收盘'].values / df_raw['收盘'].values
-        })
+    return df_adj.sort_values('date', ignore_index=True)
 
-        return df_adj
 
-    return fetch()
+def align_adj_factor(date_keys: np.ndarray, adj_keys: np.ndarray,
+                     adj_factors: np.ndarray) -> np.ndarray:
+    """为每根K线取不晚于其日期的最近一个复权因子
+
+    复权因子按日期升序排列，用 np.searchsorted 二分定位，不需要构建哈希表或排序合并。
+
+    Args:
+        date_keys: K线的 yyyymmdd 日期键
+        adj_keys: 复权因子的 yyyymmdd 日期键（升序）
+        adj_factors: 与 adj_keys 对应的复权因子
+
+    Returns:
+        与 date_keys 等长的复权因子数组，没有可用因子（或因子缺失）的位置为 1.0
+    """
+    pos = np.searchsorted(adj_keys, date_keys, side='right') - 1
+    factors = np.where(pos >= 0, adj_factors[np.maximum(pos, 0)], 1.0)
+    return np.where(np.isnan(factors), 1.0, factors)
 
 
 # ==================== K线数据获取模块 ====================
 
-def fetch_kline_daily(symbol: str, start_date: str, end_date: str) -> Optional[pd.DataFrame]:
+async def fetch_kline_daily(session: aiohttp.ClientSession, symbol: str,
+                            start_date: str, end_date: str) -> Optional[pd.DataFrame]:
     """获取单个股票的日线K线数据（不复权 + 复权因子）
 
     Args:
+        session: 共享的 aiohttp 会话
         symbol: 股票代码
         start_date: 开始日期 (YYYYMMDD)
         end_date: 结束日期 (YYYYMMDD)
@@ -128,99 +457,528 @@ def fetch_kline_daily(symbol: str, start_date: str, end_date: str) -> Optional[p
     Returns:
         包含日线K线数据和复权因子的DataFrame
     """
-    @retry_on_error
-    def fetch_daily_data():
-        # 获取不复权日线数据
-        df = ak.stock_zh_a_hist(
-            symbol=symbol,
-            period="daily",
-            start_date=start_date,
-            end_date=end_date,
-            adjust=""  # 不复权
-        )
-        return df
-
-    # 获取日线数据
-    df_kline = fetch_daily_data()
+    # 同时请求不复权日线数据（东方财富）和复权因子（新浪），两个请求互不依赖
+    df_kline, df_adj = await asyncio.gather(
+        fetch_hist(session, symbol, start_date, end_date, adjust=""),
+        fetch_adj_factor(session, symbol),
+    )
     if df_kline is None or df_kline.empty:
         return None
 
-    # 获取复权因子
-    df_adj = fetch_adj_factor(symbol, start_date, end_date)
+    dates = pd.to_datetime(df_kline['日期'], format='%Y-%m-%d')
+
+    # 合并复权因子：取每个交易日之前最近一个除权日的因子，第一个除权日之前使用默认值
     if df_adj is None or df_adj.empty:
         print(f"  警告: 无法获取复权因子，使用默认值1.0")
-        df_adj = pd.DataFrame({
-            'date': pd.to_datetime(df_kline['日期']),
-            'adj_factor': 1.0
-        })
+        adj_factor = np.ones(len(df_kline))
+    else:
+        adj_factor = align_adj_factor(to_date_keys(dates), to_date_keys(df_adj['date']),
+                                      df_adj['adj_factor'].to_numpy(dtype=np.float64))
+
+    # 直接用各列数组一次构造结果，不复制、重命名或重新选择列
+    df_result = pd.DataFrame({
+        'date': dates.to_numpy(),
+        'symbol': symbol,
+        'open': df_kline['开盘'].to_numpy(),
+        'high': df_kline['最高'].to_numpy(),
+        'low': df_kline['最低'].to_numpy(),
+        'close': df_kline['收盘'].to_numpy(),
+        'volume': df_kline['成交量'].to_numpy(),
+        'amount': df_kline['成交额'].to_numpy(),
+        'adj_factor': adj_factor,
+    }, columns=KLINE_COLUMNS)
 
-    # 标准化列名
-    df_kline = df_kline[['日期', '开盘', '最高', '最低', '收盘', '成交量', '成交额']].copy()
-    df_kline.columns = ['date', 'open', 'high', 'low', 'close', 'volume', 'amount']
-    df_kline['date'] = pd.to_datetime(df_kline['date'])
+    return df_result
 
-    # 合并复权因子（按日期）
-    df_result = df_kline.merge(df_adj[['date', 'adj_factor']], on='date', how='left')
 
-    # 填充缺失的复权因子（使用前向填充）
-    df_result['adj_factor'] = df_result['adj_factor'].ffill()
-    df_result['adj_factor'] = df_result['adj_factor'].fillna(1.0)
+# ==================== 数据保存模块 ====================
 
-    # 添加股票代码
-    df_result['symbol'] = symbol
+def to_kline_table(df: pd.DataFrame) -> pa.Table:
+    """将K线DataFrame转换为固定schema的Arrow表"""
+    return pa.Table.from_pandas(df[KLINE_COLUMNS], schema=KLINE_SCHEMA, preserve_index=False)
 
-    # 选择最终列
-    df_result = df_result[['date', 'symbol', 'open', 'high', 'low', 'close',
-                           'volume', 'amount', 'adj_factor']]
 
-    return df_result
+def kline_row_keys(table: pa.Table) -> pa.Array:
+    """把自然键 (symbol, date) 打包成单个 int64 键
 
+    高位为 symbol 的字典编码序号，低32位为自1970-01-01起的天数，键与 (symbol, date)
+    一一对应，不存在哈希冲突。去重时只需对一列定长整数做哈希，不必逐行比较字符串。
+    """
+    symbol_ids = pc.dictionary_encode(table['symbol'].combine_chunks()).indices
+    days = table['date'].combine_chunks().cast(pa.int64()).to_numpy() // 86_400_000_000
+    return pa.array(symbol_ids.to_numpy().astype(np.int64) * (1 << 32) + days)
 
-# ==================== 数据保存模块 ====================
 
-def save_to_parquet(df: pd.DataFrame, symbol: str, mode: str = 'overwrite'):
-    """保存数据到Parquet文件
+def drop_duplicate_rows(table: pa.Table, row_keys: pa.Array) -> pa.Table:
+    """按单列键去重，保留最后出现的记录
+
+    在 Arrow 中按键哈希分组、取每组最大的行号，不经过 pandas。
 
     Args:
-        df: 数据DataFrame
-        symbol: 股票代码
-        mode: 保存模式 ('overwrite' 或 'append')
+        table: 待去重的表
+        row_keys: 与 table 逐行对应的键，例如 kline_row_keys(table)
+    """
+    last_rows = (pa.table({'key': row_keys,
+                           'row_number': np.arange(table.num_rows, dtype=np.int64)})
+                 .group_by('key')
+                 .aggregate([('row_number', 'max')])['row_number_max'])
+    return table.take(last_rows)
+
+
+class KlineDatasetWriter:
+    """按年份分区流式写入K线数据集
+
+    多只股票的数据先在内存中累积，达到 FLUSH_ROWS 行后按 (symbol, date) 排序，
+    以行组的形式追加到各年份分区的 ParquetWriter 中。每个年份分区在一个写入器的
+    生命周期内只对应一个数据文件，已有数据文件从不读取或改写。
+
+    数据先写入以 "." 开头的临时文件（数据集扫描时会忽略），commit() / close() 时才重命名为
+    正式文件，中途崩溃不会在数据集中留下不完整的文件。可在多个线程中并发调用 write()。
     """
-    file_path = os.path.join(KLINE_DIR, f"{symbol}.parquet")
-
-    if mode == 'append' and os.path.exists(file_path):
-        # 增量更新模式
-        df_existing = pd.read_parquet(file_path)
-        df_combined = pd.concat([df_existing, df], ignore_index=True)
-        df_combined.drop_duplicates(subset=['date'], keep='last', inplace=True)
-        df_combined.sort_values('date', inplace=True)
-        df_combined.to_parquet(file_path, index=False)
-    else:
-        # 覆盖模式
-        df.to_parquet(file_path, index=False)
+
+    def __init__(self, before_commit=None):
+        """
+        Args:
+            before_commit: 可选回调，commit() 在重命名数据文件之前（持有锁）以即将提交的
+                正式文件路径列表调用，用于在数据进入数据集之前记录需要合并的分区
+        """
+        self.lock = threading.Lock()
+        self.basename = f"part-{time.time_ns()}.parquet"
+        self.pending = []
+        self.pending_rows = 0
+        self.writers = {}  # {year: (ParquetWriter, 临时文件路径, 正式文件路径)}
+        self.written_files = []
+        self.before_commit = before_commit
+
+    def write(self, df: pd.DataFrame):
+        """追加一只股票的数据"""
+        self.write_table(to_kline_table(df))
+
+    def write_table(self, table: pa.Table):
+        """追加符合 KLINE_SCHEMA 的Arrow表"""
+        with self.lock:
+            self.pending.append(table)
+            self.pending_rows += table.num_rows
+            if self.pending_rows >= FLUSH_ROWS:
+                self.flush()
+
+    def flush(self):
+        """将内存中累积的数据作为行组写出（调用方需持有锁或确保没有并发写入）"""
+        if not self.pending:
+            return
+
+        table = pa.concat_tables(self.pending).sort_by([('symbol', 'ascending'),
+                                                        ('date', 'ascending')])
+        years = pc.year(table['date'])
+        for year in pc.unique(years).to_pylist():
+            chunk = table.filter(pc.equal(years, year))
+            self.get_writer(year).write_table(chunk, row_group_size=ROW_GROUP_SIZE)
+
+        self.pending = []
+        self.pending_rows = 0
+
+    def get_writer(self, year: int) -> pq.ParquetWriter:
+        """返回年份分区对应的写入器，首次使用时创建"""
+        if year not in self.writers:
+            partition_dir = os.path.join(KLINE_DIR, f"year={year}")
+            Path(partition_dir).mkdir(parents=True, exist_ok=True)
+            tmp_path = os.path.join(partition_dir, f".{self.basename}.tmp")
+            file_path = os.path.join(partition_dir, self.basename)
+            writer = pq.ParquetWriter(tmp_path, KLINE_SCHEMA, **PARQUET_WRITE_OPTIONS)
+            self.writers[year] = (writer, tmp_path, file_path)
+        return self.writers[year][0]
+
+    def commit(self):
+        """写出内存中的数据，关闭当前的数据文件并重命名为正式文件
+
+        commit() 返回后，之前 write() 过的数据都已完整落盘；之后的写入会使用新的数据文件。
+        """
+        with self.lock:
+            self.flush()
+            if self.before_commit is not None and self.writers:
+                self.before_commit([file_path for _, _, file_path in self.writers.values()])
+            for writer, tmp_path, file_path in self.writers.values():
+                writer.close()
+                os.replace(tmp_path, file_path)
+                self.written_files.append(file_path)
+            self.writers = {}
+            self.basename = f"part-{time.time_ns()}.parquet"
+
+    def close(self) -> List[str]:
+        """写出剩余数据并关闭所有写入器
+
+        Returns:
+            本次写入的所有数据文件路径
+        """
+        self.commit()
+        return self.written_files
+
+
+def list_partition_files(partition_dir: str) -> List[str]:
+    """按写入顺序返回分区下的所有数据文件"""
+    return sorted(str(p) for p in Path(partition_dir).glob("*.parquet"))
+
+
+def remove_stale_tmp_files():
+    """删除上次运行中断时遗留的临时数据文件（year=*/.part-*.parquet.tmp）
+
+    临时文件只在 KlineDatasetWriter.commit() 时才重命名为正式文件，未提交的数据
+    不会被断点记录，下次运行会重新下载，因此可以直接删除。需在创建新的写入器之前调用。
+    """
+    stale_files = list(Path(KLINE_DIR).glob("year=*/.part-*.parquet.tmp"))
+    for file_path in stale_files:
+        file_path.unlink()
+    if stale_files:
+        print(f"已删除 {len(stale_files)} 个中断运行遗留的临时文件")
 
 
-def check_existing_data(symbol: str) -> Optional[str]:
-    """检查已存在的数据，返回最新日期
+def compact_partition(partition_dir: str):
+    """合并分区下的数据文件：按 (symbol, date) 去重（保留最后写入的记录）、排序后重写
 
     Args:
-        symbol: 股票代码
+        partition_dir: 年份分区目录，例如 data/kline_daily/year=2024
+    """
+    fragments = list_partition_files(partition_dir)
+    if not fragments:
+        return
+
+    table = ds.dataset(fragments, format='parquet').to_table(columns=KLINE_COLUMNS)
+    table = table.cast(KLINE_SCHEMA)
+    table = drop_duplicate_rows(table, kline_row_keys(table))
+
+    # 先写入合并后的新文件，再删除旧文件
+    writer = KlineDatasetWriter()
+    writer.write_table(table)
+    writer.close()
+    for file_path in fragments:
+        os.remove(file_path)
+
+
+def compact_dataset(written_files: List[str]):
+    """合并需要去重的分区
+
+    包括断点记录中待合并的分区（全量下载替换过已有数据，可能来自此前中断的运行），
+    以及本次写入后文件数超过 COMPACT_THRESHOLD 的分区。待合并记录在分区合并完成后
+    才删除，合并中途崩溃时下次运行会重新合并。
+
+    Args:
+        written_files: 本次运行写入的文件路径
+    """
+    pending = set(load_pending_compaction())
+    for partition_dir in sorted(pending | {os.path.dirname(f) for f in written_files}):
+        fragments = list_partition_files(partition_dir)
+        if (partition_dir in pending and len(fragments) > 1) or len(fragments) > COMPACT_THRESHOLD:
+            print(f"合并分区: {partition_dir} ({len(fragments)} 个文件)")
+            compact_partition(partition_dir)
+        if partition_dir in pending:
+            clear_pending_compaction(partition_dir)
+
+
+def migrate_legacy_files():
+    """将旧版数据迁移到按年份分区的数据集
+
+    旧版布局: {KLINE_DIR}/{symbol}.parquet 或 {KLINE_DIR}/symbol={symbol}/part-*.parquet
+    """
+    legacy_files = sorted(Path(KLINE_DIR).glob("*.parquet"))
+    legacy_partitions = sorted(p for p in Path(KLINE_DIR).glob("symbol=*") if p.is_dir())
+    if not legacy_files and not legacy_partitions:
+        return
+
+    print(f"迁移 {len(legacy_files) + len(legacy_partitions)} 只股票的旧版数据到按年份分区的数据集...")
+    writer = KlineDatasetWriter()
+    for file_path in legacy_files:
+        writer.write(pd.read_parquet(file_path))
+    for partition_dir in legacy_partitions:
+        df = pd.read_parquet(partition_dir)
+        df['symbol'] = partition_dir.name.split('=', 1)[1]
+        writer.write(df)
+    writer.close()
+
+    for file_path in legacy_files:
+        file_path.unlink()
+    for partition_dir in legacy_partitions:
+        shutil.rmtree(partition_dir)
+
+
+def load_latest_dates(symbols: List[str]) -> Dict[str, str]:
+    """读取指定股票在数据集中的最新日期
+
+    从最新的年份分区往前逐个读取，每个分区只读 symbol 和 date 两列、只保留尚未找到的
+    股票（利用行组的 symbol 统计信息跳过无关行组）。较新分区中出现的日期一定晚于旧分区，
+    所有股票都找到后即停止，通常只需读取最近一两个分区。
+
+    Args:
+        symbols: 需要查询的股票代码
 
     Returns:
-        最新日期字符串 (YYYYMMDD) 或 None
+        {股票代码: 最新日期字符串 (YYYYMMDD)}，数据集中没有的股票不在结果中
     """
-    file_path = os.path.join(KLINE_DIR, f"{symbol}.parquet")
-    if not os.path.exists(file_path):
-        return None
+    partitions = [p for p in Path(KLINE_DIR).glob("year=*") if p.is_dir()]
+    partitions.sort(key=lambda p: int(p.name.split('=', 1)[1]), reverse=True)
+
+    latest_dates = {}
+    missing = set(symbols)
+    for partition_dir in partitions:
+        if not missing:
+            break
+        fragments = list_partition_files(partition_dir)
+        if not fragments:
+            continue
+
+        table = ds.dataset(fragments, format='parquet').to_table(
+            columns=['symbol', 'date'], filter=pc.field('symbol').isin(sorted(missing)))
+        grouped = table.group_by('symbol').aggregate([('date', 'max')])
+        for symbol, date in zip(grouped['symbol'].to_pylist(), grouped['date_max'].to_pylist()):
+            latest_dates[symbol] = date.strftime('%Y%m%d')
+            missing.discard(symbol)
+
+    return latest_dates
+
+
+# ==================== 断点续传模块 ====================
+
+def connect_checkpoint() -> sqlite3.Connection:
+    """打开断点记录数据库，不存在时创建"""
+    conn = sqlite3.connect(CHECKPOINT_FILE)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS completed (
+            symbol TEXT PRIMARY KEY,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE TABLE IF NOT EXISTS pending_compaction (partition_dir TEXT PRIMARY KEY)")
+    return conn
+
+
+def load_completed_symbols(start_date: str, end_date: str) -> set:
+    """返回已完整下载过 [start_date, end_date] 区间的股票代码"""
+    conn = connect_checkpoint()
+    try:
+        rows = conn.execute(
+            "SELECT symbol FROM completed WHERE start_date <= ? AND end_date >= ?",
+            (start_date, end_date),
+        ).fetchall()
+    finally:
+        conn.close()
+    return {symbol for (symbol,) in rows}
+
+
+def clear_completed():
+    """清空已完成记录（--no-resume 重新下载时调用，之后按新一轮运行重新记录）"""
+    conn = connect_checkpoint()
+    try:
+        conn.execute("DELETE FROM completed")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def remove_completed(symbols: List[str]):
+    """删除指定股票的已完成记录（数据已不在数据集中时调用）"""
+    if not symbols:
+        return
+
+    conn = connect_checkpoint()
+    try:
+        conn.executemany("DELETE FROM completed WHERE symbol = ?", [(symbol,) for symbol in symbols])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def mark_completed(symbols: List[str], start_date: str, end_date: str):
+    """记录一批已落盘的股票（调用前其数据必须已由 KlineDatasetWriter.commit() 写入）"""
+    if not symbols:
+        return
+
+    updated_at = datetime.now().isoformat(timespec='seconds')
+    conn = connect_checkpoint()
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO completed (symbol, start_date, end_date, updated_at) "
+            "VALUES (?, ?, ?, ?)",
+            [(symbol, start_date, end_date, updated_at) for symbol in symbols],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def mark_pending_compaction(partition_dirs: List[str]):
+    """记录需要合并去重的分区（在新数据文件进入分区之前调用）"""
+    if not partition_dirs:
+        return
+
+    conn = connect_checkpoint()
+    try:
+        conn.executemany("INSERT OR IGNORE INTO pending_compaction (partition_dir) VALUES (?)",
+                         [(partition_dir,) for partition_dir in partition_dirs])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_pending_compaction() -> List[str]:
+    """返回待合并的分区目录"""
+    conn = connect_checkpoint()
+    try:
+        rows = conn.execute("SELECT partition_dir FROM pending_compaction").fetchall()
+    finally:
+        conn.close()
+    return [partition_dir for (partition_dir,) in rows]
+
 
+def clear_pending_compaction(partition_dir: str):
+    """分区合并完成后删除其待合并记录"""
+    conn = connect_checkpoint()
     try:
-        df = pd.read_parquet(file_path)
-        if df.empty:
+        conn.execute("DELETE FROM pending_compaction WHERE partition_dir = ?", (partition_dir,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ==================== 并发下载模块 ====================
+
+async def process_symbol(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                         writer: KlineDatasetWriter, latest_dates: Dict[str, str],
+                         symbol: str, name: str, args) -> Optional[str]:
+    """下载并保存单个股票的日线数据
+
+    Args:
+        session: 共享的 aiohttp 会话
+        semaphore: 限制并发股票数量的信号量
+        writer: 数据集写入器
+        latest_dates: 已有数据中每只股票的最新日期（增量更新模式）
+        symbol: 股票代码
+        name: 股票名称
+        args: 命令行参数
+
+    Returns:
+        失败原因，成功时返回 None
+    """
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        try:
+            # 增量更新模式：检查已有数据
+            start_date = args.start_date
+            if args.update:
+                latest_date = latest_dates.get(symbol)
+                if latest_date:
+                    # 从最新日期的下一天开始
+                    start_date = (datetime.strptime(latest_date, '%Y%m%d') +
+                                  timedelta(days=1)).strftime('%Y%m%d')
+                    if start_date > args.end_date:
+                        print(f"[{symbol}] {name} - 数据已是最新，跳过")
+                        return None
+
+            # 获取K线数据
+            df = await fetch_kline_daily(session, symbol, start_date, args.end_date)
+
+            if df is None or df.empty:
+                print(f"[{symbol}] {name} - 无数据")
+                return "无数据"
+
+            # 保存数据（Parquet写入为同步IO，交给线程池执行）
+            await loop.run_in_executor(None, writer.write, df)
+
+            print(f"[{symbol}] {name} - 成功 ({len(df)} 条记录)")
             return None
-        latest_date = df['date'].max()
-        return latest_date.strftime('%Y%m%d')
-    except Exception:
-        return None
+
+        except Exception as e:
+            print(f"[{symbol}] {name} - 失败: {str(e)}")
+            return str(e)
+
+
+async def download_all(stock_list: pd.DataFrame, args) -> List[tuple]:
+    """并发下载所有股票的日线数据
+
+    Args:
+        stock_list: 股票列表，包含 symbol 和 name 列
+        args: 命令行参数
+
+    Returns:
+        失败股票列表 [(symbol, name, error), ...]
+    """
+    loop = asyncio.get_running_loop()
+
+    # 跳过断点记录中已完整下载过本次日期区间的股票；--no-resume 时清空旧记录，
+    # 否则本次运行中断后无法正确续传，之后的普通运行还会按旧记录跳过股票
+    completed = set()
+    if args.no_resume:
+        await loop.run_in_executor(None, clear_completed)
+    else:
+        completed = await loop.run_in_executor(None, load_completed_symbols,
+                                               args.start_date, args.end_date)
+        completed &= set(stock_list['symbol'])
+
+    # 断点记录只说明数据曾经写入过，数据集被删除或移动后仍需重新下载：
+    # 已完成的股票必须在数据集中有数据，否则删除其记录
+    if completed:
+        present = await loop.run_in_executor(None, load_latest_dates, sorted(completed))
+        stale = sorted(completed - present.keys())
+        if stale:
+            print(f"断点续传: {len(stale)} 只股票的数据已不在数据集中，重新下载")
+            await loop.run_in_executor(None, remove_completed, stale)
+            completed -= set(stale)
+
+    skipped = stock_list['symbol'].isin(completed)
+    if skipped.any():
+        print(f"断点续传: 跳过 {skipped.sum()} 只已完成的股票")
+    stock_list = stock_list[~skipped]
+
+    symbols = stock_list['symbol'].tolist()
+    names = stock_list['name'].tolist()
+
+    latest_dates = {}
+    if args.update:
+        latest_dates = await loop.run_in_executor(None, load_latest_dates, symbols)
+    def before_commit(file_paths: List[str]):
+        """全量下载时，分区中已有其他文件就可能存在被替换的旧记录，提交前记录为待合并"""
+        if args.update:
+            return
+        written = set(writer.written_files) | set(file_paths)
+        mark_pending_compaction([
+            partition_dir for partition_dir in sorted({os.path.dirname(f) for f in file_paths})
+            if any(f not in written for f in list_partition_files(partition_dir))
+        ])
+
+    writer = KlineDatasetWriter(before_commit=before_commit)
+    uncommitted = []  # 已写入 writer、但尚未落盘记录断点的股票
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def save_checkpoint():
+        """把已写入的数据落盘，再记录对应股票的断点"""
+        batch = uncommitted[:]
+        uncommitted.clear()
+        await loop.run_in_executor(None, writer.commit)
+        await loop.run_in_executor(None, mark_completed, batch, args.start_date, args.end_date)
+
+    async def download(session: aiohttp.ClientSession, symbol: str, name: str) -> Optional[str]:
+        """下载单只股票，每完成 CHECKPOINT_INTERVAL 只记录一次断点"""
+        error = await process_symbol(session, semaphore, writer, latest_dates, symbol, name, args)
+        if error is None:
+            uncommitted.append(symbol)
+            if len(uncommitted) >= CHECKPOINT_INTERVAL:
+                await save_checkpoint()
+        return error
+
+    async with create_session() as session:
+        errors = await tqdm_asyncio.gather(
+            *[download(session, symbol, name) for symbol, name in zip(symbols, names)],
+            total=len(symbols), desc="下载进度"
+        )
+
+    # 写出剩余数据并记录断点，再合并需要去重的分区
+    await save_checkpoint()
+    written_files = await loop.run_in_executor(None, writer.close)
+    await loop.run_in_executor(None, compact_dataset, written_files)
+
+    return [(symbol, name, error)
+            for symbol, name, error in zip(symbols, names, errors)
+            if error is not None]
 
 
 # ==================== 主流程模块 ====================
@@ -238,9 +996,17 @@ def main():
                         help='增量更新模式（只下载新数据）')
     parser.add_argument('--limit', type=int, default=None,
                         help='限制下载股票数量（用于测试）')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'不使用请求缓存（{CACHE_DIR}）')
+    parser.add_argument('--no-resume', action='store_true',
+                        help=f'清空断点记录（{CHECKPOINT_FILE}），重新下载所有股票')
 
     args = parser.parse_args()
 
+    if args.no_cache:
+        global CACHE_ENABLED
+        CACHE_ENABLED = False
+
     # 设置结束日期
     if args.end_date is None:
         args.end_date = datetime.now().strftime('%Y%m%d')
@@ -255,6 +1021,9 @@ def main():
 
     # 确保目录存在
     ensure_directories()
+    prune_cache()
+    remove_stale_tmp_files()
+    migrate_legacy_files()
 
     # 获取股票列表
     if args.symbols:
@@ -271,51 +1040,14 @@ def main():
         stock_list = stock_list.head(args.limit)
         print(f"限制下载数量: {args.limit}")
 
-    # 统计信息
     total_stocks = len(stock_list)
-    success_count = 0
-    failed_stocks = []
 
-    print(f"\n开始下载 {total_stocks} 只股票的日线K线数据...")
+    print(f"\n开始下载 {total_stocks} 只股票的日线K线数据（并发数: {MAX_CONCURRENCY}）...")
     print("=" * 60)
 
-    # 遍历每个股票
-    for idx, row in tqdm(stock_list.iterrows(), total=total_stocks, desc="下载进度"):
-        symbol = row['symbol']
-        name = row.get('name', '')
-
-        try:
-            # 增量更新模式：检查已有数据
-            start_date = args.start_date
-            if args.update:
-                latest_date = check_existing_data(symbol)
-                if latest_date:
-                    # 从最新日期的下一天开始
-                    start_date = (datetime.strptime(latest_date, '%Y%m%d') +
-                                  timedelta(days=1)).strftime('%Y%m%d')
-                    if start_date > args.end_date:
-                        print(f"[{symbol}] {name} - 数据已是最新，跳过")
-                        success_count += 1
-                        continue
-
-            # 获取K线数据
-            df = fetch_kline_daily(symbol, start_date, args.end_date)
-
-            if df is None or df.empty:
-                print(f"[{symbol}] {name} - 无数据")
-                failed_stocks.append((symbol, name, "无数据"))
-                continue
-
-            # 保存数据
-            save_mode = 'append' if args.update else 'overwrite'
-            save_to_parquet(df, symbol, mode=save_mode)
-
-            success_count += 1
-            print(f"[{symbol}] {name} - 成功 ({len(df)} 条记录)")
-
-        except Exception as e:
-            print(f"[{symbol}] {name} - 失败: {str(e)}")
-            failed_stocks.append((symbol, name, str(e)))
+    # 并发下载所有股票
+    failed_stocks = asyncio.run(download_all(stock_list, args))
+    success_count = total_stocks - len(failed_stocks)
 
     # 生成下载报告
     print("\n" + "=" * 60)
@@ -8,12 +8,17 @@ import os
 import sys
 import time
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import List, Optional, Dict
 
 import akshare as ak
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
 
@@ -22,9 +27,17 @@ from tqdm import tqdm
 DATA_DIR = "data"
 KLINE_DIR = "data/kline_5m"
 STOCK_LIST_FILE = "data/stock_list.parquet"
+STOCK_LIST_TTL = 24 * 3600  # 股票列表文件的有效期（秒），有效期内不再重新获取
 DEFAULT_START_DATE = "20190101"
 MAX_RETRIES = 3
-REQUEST_DELAY = 0.5  # 请求间隔（秒）
+REQUEST_DELAY = 0.5  # 重试退避的基准间隔（秒）
+REQUEST_RATE = 15  # 每秒最多发出的请求数（令牌桶速率）
+REQUEST_BURST = 15  # 令牌桶容量，允许的瞬时突发请求数
+MAX_WORKERS = 8  # 同时下载的股票数量（线程数）
+# 所有Parquet文件的写入参数：zstd 3级压缩、1MB数据页，symbol 列使用字典编码
+PARQUET_WRITE_OPTIONS = dict(compression='zstd', compression_level=3,
+                             use_dictionary=['symbol'], data_page_size=1 << 20,
+                             write_statistics=True)
 
 
 # ==================== 工具函数 ====================
@@ -41,9 +54,7 @@ def retry_on_error(func, max_retries=MAX_RETRIES, delay=REQUEST_DELAY):
     def wrapper(*args, **kwargs):
         for attempt in range(max_retries):
             try:
-                result = func(*args, **kwargs)
-                time.sleep(delay)  # 请求间隔
-                return result
+                return func(*args, **kwargs)
             except Exception as e:
                 if attempt == max_retries - 1:
                     raise e
@@ -53,10 +64,64 @@ def retry_on_error(func, max_retries=MAX_RETRIES, delay=REQUEST_DELAY):
     return wrapper
 
 
+def to_date_keys(dates) -> np.ndarray:
+    """把日期转换为 int32 的 yyyymmdd 整数键
+
+    合并、排序复权因子时用它代替 datetime64（8字节）或 Python date 对象作为键。
+    """
+    dates = pd.DatetimeIndex(dates)
+    return (dates.year * 10000 + dates.month * 100 + dates.day).to_numpy(dtype=np.int32)
+
+
+class TokenBucket:
+    """线程安全的令牌桶限速器
+
+    令牌以 rate 个/秒的速度补充，最多积累 capacity 个；每次请求前 acquire() 取走一个
+    令牌，令牌不足时等待。服务器空闲时可以连续发出 capacity 个请求，长期速率不超过 rate。
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """取走一个令牌，令牌不足时等待补充（等待时不持有锁）"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# 所有下载线程共用一个限速器
+RATE_LIMITER = TokenBucket(REQUEST_RATE, REQUEST_BURST)
+
+# 与分钟数据请求同时获取复权因子的线程池（每个下载线程最多占用一个）
+FACTOR_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
 # ==================== 股票列表获取模块 ====================
 
 def get_stock_list() -> pd.DataFrame:
-    """获取所有A股股票代码列表"""
+    """获取所有A股股票代码列表
+
+    STOCK_LIST_FILE 在 STOCK_LIST_TTL 内写入过时直接读取，不再请求行情快照接口。
+    """
+    if os.path.exists(STOCK_LIST_FILE):
+        age = time.time() - os.path.getmtime(STOCK_LIST_FILE)
+        if age < STOCK_LIST_TTL:
+            stock_list = pd.read_parquet(STOCK_LIST_FILE)
+            print(f"使用 {age / 3600:.1f} 小时前保存的股票列表: {STOCK_LIST_FILE}, 共 {len(stock_list)} 只股票")
+            return stock_list
+
     print("正在获取A股股票列表...")
 
     @retry_on_error
@@ -72,7 +137,8 @@ def get_stock_list() -> pd.DataFrame:
     stock_list.columns = ['symbol', 'name']
 
     # 保存到文件
-    stock_list.to_parquet(STOCK_LIST_FILE, index=False)
+    pq.write_table(pa.Table.from_pandas(stock_list, preserve_index=False), STOCK_LIST_FILE,
+                   **PARQUET_WRITE_OPTIONS)
     print(f"股票列表已保存: {STOCK_LIST_FILE}, 共 {len(stock_list)} 只股票")
 
     return stock_list
@@ -83,21 +149,24 @@ def get_stock_list() -> pd.DataFrame:
 def fetch_adj_factor(symbol: str, start_date: str, end_date: str) -> Optional[pd.DataFrame]:
     """获取复权因子
 
+    分母使用不复权日线的收盘价：5分钟K线每天最后一根的收盘价在缺少收盘集合竞价、
+    由1分钟K线聚合或盘中下载时并不等于当日收盘价，用它计算的因子会逐日漂移。
+
     Args:
         symbol: 股票代码
         start_date: 开始日期 (YYYYMMDD)
         end_date: 结束日期 (YYYYMMDD)
 
     Returns:
-        包含日期和复权因子的DataFrame，列名为 ['date', 'adj_factor']
+        包含日期键和复权因子的DataFrame，列名为 ['date_key', 'adj_factor']
     """
     @retry_on_error
     def fetch():
-        # 使用后复权日线数据来计算复权因子
-        # 获取不复权和后复权数据，计算复权因子
+        RATE_LIMITER.acquire()
         df_qfq = ak.stock_zh_a_hist(symbol=symbol, period="daily",
                                      start_date=start_date, end_date=end_date,
                                      adjust="qfq")  # 前复权
+        RATE_LIMITER.acquire()
         df_raw = ak.stock_zh_a_hist(symbol=symbol, period="daily",
                                      start_date=start_date, end_date=end_date,
                                      adjust="")  # 不复权
@@ -105,10 +174,13 @@ def fetch_adj_factor(symbol: str, start_date: str, end_date: str) -> Optional[pd
         if df_qfq is None or df_raw is None or df_qfq.empty or df_raw.empty:
             return None
 
-        # 计算复权因子 = 前复权价格 / 不复权价格
+        # 计算复权因子 = 前复权价格 / 不复权价格（按日期对齐）
+        qfq_close = pd.Series(df_qfq['收盘'].values, index=to_date_keys(df_qfq['日期']))
+        raw_close = pd.Series(df_raw['收盘'].values, index=to_date_keys(df_raw['日期']))
+        qfq_close, raw_close = qfq_close.align(raw_close, join='inner')
         df_adj = pd.DataFrame({
-            'date': pd.to_datetime(df_raw['日期']),
-            'adj_factor': df_qfq['收盘'].values / df_raw['收盘'].values
+            'date_key': qfq_close.index,
+            'adj_factor': qfq_close.values / raw_close.values
         })
 
         return df_adj
@@ -116,6 +188,25 @@ def fetch_adj_factor(symbol: str, start_date: str, end_date: str) -> Optional[pd
     return fetch()
 
 
+def align_adj_factor(date_keys: np.ndarray, adj_keys: np.ndarray,
+                     adj_factors: np.ndarray) -> np.ndarray:
+    """为每根K线取不晚于其日期的最近一个复权因子
+
+    复权因子按日期升序排列，用 np.searchsorted 二分定位，不需要构建哈希表或排序合并。
+
+    Args:
+        date_keys: K线的 yyyymmdd 日期键
+        adj_keys: 复权因子的 yyyymmdd 日期键（升序）
+        adj_factors: 与 adj_keys 对应的复权因子
+
+    Returns:
+        与 date_keys 等长的复权因子数组，没有可用因子（或因子缺失）的位置为 1.0
+    """
+    pos = np.searchsorted(adj_keys, date_keys, side='right') - 1
+    factors = np.where(pos >= 0, adj_factors[np.maximum(pos, 0)], 1.0)
+    return np.where(np.isnan(factors), 1.0, factors)
+
+
 # ==================== K线数据获取模块 ====================
 
 def fetch_kline_5m(symbol: str, start_date: str, end_date: str) -> Optional[pd.DataFrame]:
@@ -133,6 +224,7 @@ def fetch_kline_5m(symbol: str, start_date: str, end_date: str) -> Optional[pd.D
     def fetch_minute_data():
         # 尝试获取5分钟数据
         try:
+            RATE_LIMITER.acquire()
             df = ak.stock_zh_a_hist_min_em(symbol=symbol, period="5",
                                            start_date=start_date, end_date=end_date,
                                            adjust="")  # 不复权
@@ -140,6 +232,7 @@ def fetch_kline_5m(symbol: str, start_date: str, end_date: str) -> Optional[pd.D
         except Exception as e:
             # 如果5分钟数据不可用，尝试获取1分钟数据并聚合
             print(f"  5分钟数据不可用，尝试使用1分钟数据聚合: {str(e)}")
+            RATE_LIMITER.acquire()
             df_1m = ak.stock_zh_a_hist_min_em(symbol=symbol, period="1",
                                               start_date=start_date, end_date=end_date,
                                               adjust="")  # 不复权
@@ -163,45 +256,61 @@ def fetch_kline_5m(symbol: str, start_date: str, end_date: str) -> Optional[pd.D
             df_5m.columns = ['时间', '开盘', '最高', '最低', '收盘', '成交量', '成交额']
             return df_5m
 
+    # 复权因子的日线请求与分钟数据请求互不依赖，在后台线程中同时进行
+    factor_future = FACTOR_EXECUTOR.submit(fetch_adj_factor, symbol, start_date, end_date)
+
     # 获取分钟数据
     df_kline = fetch_minute_data()
     if df_kline is None or df_kline.empty:
+        factor_future.cancel()
         return None
 
     # 获取复权因子
-    df_adj = fetch_adj_factor(symbol, start_date, end_date)
+    df_adj = factor_future.result()
+    bar_times = pd.to_datetime(df_kline['时间'])
+    bar_dates = to_date_keys(bar_times)
+
+    # 合并复权因子：当天没有因子时沿用之前最近一天的因子，再之前没有则为 1.0
     if df_adj is None or df_adj.empty:
         print(f"  警告: 无法获取复权因子，使用默认值1.0")
-        df_adj = pd.DataFrame({
-            'date': pd.to_datetime(df_kline['时间']).dt.date.unique(),
-            'adj_factor': 1.0
-        })
-
-    # 标准化列名 - 选择需要的列
-    df_kline = df_kline[['时间', '开盘', '最高', '最低', '收盘', '成交量', '成交额']].copy()
-    df_kline.columns = ['datetime', 'open', 'high', 'low', 'close', 'volume', 'amount']
-    df_kline['datetime'] = pd.to_datetime(df_kline['datetime'])
-    df_kline['date'] = df_kline['datetime'].dt.date
+        adj_factor = np.ones(len(df_kline))
+    else:
+        adj_factor = align_adj_factor(bar_dates, df_adj['date_key'].to_numpy(),
+                                      df_adj['adj_factor'].to_numpy(dtype=np.float64))
+
+    # 直接用各列数组一次构造结果，不复制、重命名或重新选择列
+    df_result = pd.DataFrame({
+        'datetime': bar_times.to_numpy(),
+        'symbol': symbol,
+        'open': df_kline['开盘'].to_numpy(),
+        'high': df_kline['最高'].to_numpy(),
+        'low': df_kline['最低'].to_numpy(),
+        'close': df_kline['收盘'].to_numpy(),
+        'volume': df_kline['成交量'].to_numpy(),
+        'amount': df_kline['成交额'].to_numpy(),
+        'adj_factor': adj_factor,
+    })
 
-    # 合并复权因子（按日期）
-    df_adj['date'] = df_adj['date'].dt.date
-    df_result = df_kline.merge(df_adj[['date', 'adj_factor']], on='date', how='left')
+    return df_result
 
-    # 填充缺失的复权因子（使用前向填充）
-    df_result['adj_factor'] = df_result['adj_factor'].ffill()
-    df_result['adj_factor'] = df_result['adj_factor'].fillna(1.0)
 
-    # 添加股票代码
-    df_result['symbol'] = symbol
+# ==================== 数据保存模块 ====================
 
-    # 选择最终列
-    df_result = df_result[['datetime', 'symbol', 'open', 'high', 'low', 'close',
-                           'volume', 'amount', 'adj_factor']]
+def drop_duplicate_rows(table: pa.Table, row_keys: pa.Array) -> pa.Table:
+    """按单列键去重，保留最后出现的记录
 
-    return df_result
+    在 Arrow 中按键哈希分组、取每组最大的行号，不经过 pandas。
 
+    Args:
+        table: 待去重的表
+        row_keys: 与 table 逐行对应的键
+    """
+    last_rows = (pa.table({'key': row_keys,
+                           'row_number': np.arange(table.num_rows, dtype=np.int64)})
+                 .group_by('key')
+                 .aggregate([('row_number', 'max')])['row_number_max'])
+    return table.take(last_rows)
 
-# ==================== 数据保存模块 ====================
 
 def save_to_parquet(df: pd.DataFrame, symbol: str, mode: str = 'overwrite'):
     """保存数据到Parquet文件
@@ -214,15 +323,18 @@ def save_to_parquet(df: pd.DataFrame, symbol: str, mode: str = 'overwrite'):
     file_path = os.path.join(KLINE_DIR, f"{symbol}.parquet")
 
     if mode == 'append' and os.path.exists(file_path):
-        # 增量更新模式
-        df_existing = pd.read_parquet(file_path)
-        df_combined = pd.concat([df_existing, df], ignore_index=True)
-        df_combined.drop_duplicates(subset=['datetime'], keep='last', inplace=True)
-        df_combined.sort_values('datetime', inplace=True)
-        df_combined.to_parquet(file_path, index=False)
+        # 增量更新模式：在 Arrow 中合并、去重、排序，不转换为 pandas
+        table_existing = pq.read_table(file_path)
+        table_new = pa.Table.from_pandas(df, preserve_index=False).cast(table_existing.schema)
+        table_combined = pa.concat_tables([table_existing, table_new])
+        # 5分钟时间戳本身就是单列定长键，直接按其 int64 值哈希去重
+        table_combined = drop_duplicate_rows(table_combined,
+                                             table_combined['datetime'].cast(pa.int64()))
+        pq.write_table(table_combined.sort_by('datetime'), file_path, **PARQUET_WRITE_OPTIONS)
     else:
         # 覆盖模式
-        df.to_parquet(file_path, index=False)
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), file_path,
+                       **PARQUET_WRITE_OPTIONS)
 
 
 def check_existing_data(symbol: str) -> Optional[str]:
@@ -248,6 +360,75 @@ def check_existing_data(symbol: str) -> Optional[str]:
         return None
 
 
+# ==================== 并发下载模块 ====================
+
+def process_symbol(symbol: str, name: str, args) -> Optional[str]:
+    """下载并保存单个股票的5分钟K线数据
+
+    Args:
+        symbol: 股票代码
+        name: 股票名称
+        args: 命令行参数
+
+    Returns:
+        失败原因，成功（或已是最新）时返回 None
+    """
+    try:
+        # 增量更新模式：检查已有数据
+        start_date = args.start_date
+        if args.update:
+            latest_date = check_existing_data(symbol)
+            if latest_date:
+                # 从最新日期的下一天开始
+                start_date = (datetime.strptime(latest_date, '%Y%m%d') +
+                              timedelta(days=1)).strftime('%Y%m%d')
+                if start_date > args.end_date:
+                    print(f"[{symbol}] {name} - 数据已是最新，跳过")
+                    return None
+
+        # 获取K线数据
+        df = fetch_kline_5m(symbol, start_date, args.end_date)
+
+        if df is None or df.empty:
+            print(f"[{symbol}] {name} - 无数据")
+            return "无数据"
+
+        # 保存数据（每只股票一个文件，线程之间互不影响）
+        save_mode = 'append' if args.update else 'overwrite'
+        save_to_parquet(df, symbol, mode=save_mode)
+
+        print(f"[{symbol}] {name} - 成功 ({len(df)} 条记录)")
+        return None
+
+    except Exception as e:
+        print(f"[{symbol}] {name} - 失败: {str(e)}")
+        return str(e)
+
+
+def download_all(stock_list: pd.DataFrame, args) -> List[tuple]:
+    """使用线程池并发下载所有股票的5分钟数据
+
+    Args:
+        stock_list: 股票列表，包含 symbol 和 name 列
+        args: 命令行参数
+
+    Returns:
+        失败股票列表 [(symbol, name, error), ...]
+    """
+    failed_stocks = []
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(process_symbol, symbol, name, args): (symbol, name)
+                   for symbol, name in zip(stock_list['symbol'], stock_list['name'])}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="下载进度"):
+            error = future.result()
+            if error is not None:
+                symbol, name = futures[future]
+                failed_stocks.append((symbol, name, error))
+
+    return failed_stocks
+
+
 # ==================== 主流程模块 ====================
 
 def main():
@@ -296,51 +477,13 @@ def main():
         stock_list = stock_list.head(args.limit)
         print(f"限制下载数量: {args.limit}")
 
-    # 统计信息
     total_stocks = len(stock_list)
-    success_count = 0
-    failed_stocks = []
 
     print(f"\n开始下载 {total_stocks} 只股票的5分钟K线数据...")
     print("=" * 60)
 
-    # 遍历每个股票
-    for idx, row in tqdm(stock_list.iterrows(), total=total_stocks, desc="下载进度"):
-        symbol = row['symbol']
-        name = row.get('name', '')
-
-        try:
-            # 增量更新模式：检查已有数据
-            start_date = args.start_date
-            if args.update:
-                latest_date = check_existing_data(symbol)
-                if latest_date:
-                    # 从最新日期的下一天开始
-                    start_date = (datetime.strptime(latest_date, '%Y%m%d') +
-                                  timedelta(days=1)).strftime('%Y%m%d')
-                    if start_date > args.end_date:
-                        print(f"[{symbol}] {name} - 数据已是最新，跳过")
-                        success_count += 1
-                        continue
-
-            # 获取K线数据
-            df = fetch_kline_5m(symbol, start_date, args.end_date)
-
-            if df is None or df.empty:
-                print(f"[{symbol}] {name} - 无数据")
-                failed_stocks.append((symbol, name, "无数据"))
-                continue
-
-            # 保存数据
-            save_mode = 'append' if args.update else 'overwrite'
-            save_to_parquet(df, symbol, mode=save_mode)
-
-            success_count += 1
-            print(f"[{symbol}] {name} - 成功 ({len(df)} 条记录)")
-
-        except Exception as e:
-            print(f"[{symbol}] {name} - 失败: {str(e)}")
-            failed_stocks.append((symbol, name, str(e)))
+    failed_stocks = download_all(stock_list, args)
+    success_count = total_stocks - len(failed_stocks)
 
     # 生成下载报告
     print("\n" + "=" * 60)
@@ -5,14 +5,41 @@
 """
 
 import os
-import pandas as pd
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 
 # 配置
 DATA_DIR = "data"
-KLINE_DIR = "data/kline_daily"
+KLINE_DIR = "data/kline_daily"  # 按年份分区的数据集: {KLINE_DIR}/year={year}/part-*.parquet
 STOCK_LIST_FILE = "data/stock_list.parquet"
+KLINE_COLUMNS = ['date', 'symbol', 'open', 'high', 'low', 'close',
+                 'volume', 'amount', 'adj_factor']
+KLINE_PARTITIONING = ds.partitioning(pa.schema([('year', pa.int32())]), flavor='hive')
+MAX_WORKERS = 16  # 并发读取文件元数据的线程数
+FOOTER_READ_SIZE = 64 * 1024  # 读取文件尾部的字节数，通常足以一次读入完整的footer
+
+
+def load_kline_data(symbol: str) -> pd.DataFrame:
+    """从分区数据集读取单个股票的K线数据（按日期排序）
+
+    只读取需要的列，并利用行组的 symbol 统计信息跳过无关行组。
+    尚未合并的分区中可能存在重复日期，保留最后写入的记录。
+    """
+    dataset = ds.dataset(KLINE_DIR, format='parquet', partitioning=KLINE_PARTITIONING)
+    table = dataset.to_table(columns=KLINE_COLUMNS, filter=pc.field('symbol') == symbol)
+    df = table.to_pandas()
+    df = df.drop_duplicates(subset=['date'], keep='last')
+    return df.sort_values('date', ignore_index=True)
 
 
 def verify_stock_list():
@@ -47,14 +74,15 @@ def verify_kline_data(symbol: str = "000001"):
     print(f"验证股票 {symbol} 的K线数据")
     print("=" * 60)
 
-    file_path = os.path.join(KLINE_DIR, f"{symbol}.parquet")
-
-    if not os.path.exists(file_path):
-        print(f"错误: 数据文件不存在: {file_path}")
+    if not any(Path(KLINE_DIR).glob("year=*/*.parquet")):
+        print(f"错误: 数据集不存在: {KLINE_DIR}")
         return False
 
     try:
-        df = pd.read_parquet(file_path)
+        df = load_kline_data(symbol)
+        if df.empty:
+            print(f"错误: 数据集中没有股票 {symbol} 的数据")
+            return False
 
         print(f"数据行数: {len(df)}")
         print(f"数据字段: {df.columns.tolist()}")
@@ -127,13 +155,17 @@ def verify_kline_data(symbol: str = "000001"):
         print("-" * 60)
 
         if 'adj_factor' in df.columns:
-            df['adj_close'] = df['close'] * df['adj_factor']
-            df['returns'] = df['adj_close'].pct_change()
-
-            print(f"平均收益率: {df['returns'].mean():.6f}")
-            print(f"收益率标准差: {df['returns'].std():.6f}")
-            print(f"最大收益率: {df['returns'].max():.6f}")
-            print(f"最小收益率: {df['returns'].min():.6f}")
+            # 直接由相邻两根K线的 close*adj_factor 计算收益率，不生成中间列
+            adj_close = df['close'].to_numpy(dtype=np.float64) * df['adj_factor'].to_numpy(dtype=np.float64)
+            returns = adj_close[1:] / adj_close[:-1] - 1.0
+
+            if returns.size:
+                print(f"平均收益率: {np.nanmean(returns):.6f}")
+                print(f"收益率标准差: {np.nanstd(returns, ddof=1):.6f}")
+                print(f"最大收益率: {np.nanmax(returns):.6f}")
+                print(f"最小收益率: {np.nanmin(returns):.6f}")
+            else:
+                print("数据不足两条，无法计算收益率")
 
         return True
 
@@ -144,6 +176,35 @@ def verify_kline_data(symbol: str = "000001"):
         return False
 
 
+def read_parquet_metadata(file_path: Path) -> Tuple[pq.FileMetaData, int]:
+    """读取Parquet文件尾部的元数据，返回 (元数据, 文件字节数)
+
+    用一次 pread 读入文件末尾 FOOTER_READ_SIZE 字节并在内存中解析，footer 更大时再补读一次；
+    每个文件只有 open/fstat/pread/close 几次系统调用。
+    """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        tail = os.pread(fd, min(size, FOOTER_READ_SIZE), max(0, size - FOOTER_READ_SIZE))
+        # 文件末尾 8 字节为 footer 长度（小端 uint32）和魔数 "PAR1"
+        footer_size = struct.unpack('<I', tail[-8:-4])[0] + 8
+        if footer_size > len(tail):
+            tail = os.pread(fd, footer_size, size - footer_size)
+    finally:
+        os.close(fd)
+    return pq.read_metadata(pa.BufferReader(tail[-footer_size:])), size
+
+
+def read_file_stats(file_path: Path) -> Optional[Tuple[int, float]]:
+    """只读取Parquet文件尾部元数据，返回 (记录数, 文件大小MB)，读取失败返回 None"""
+    try:
+        metadata, size = read_parquet_metadata(file_path)
+        return metadata.num_rows, size / 1024 / 1024
+    except Exception as e:
+        print(f"警告: 无法读取文件 {file_path}: {str(e)}")
+        return None
+
+
 def verify_all_files():
     """验证所有下载的文件"""
     print("\n" + "=" * 60)
@@ -154,8 +215,9 @@ def verify_all_files():
         print(f"错误: K线数据目录不存在: {KLINE_DIR}")
         return
 
-    files = list(Path(KLINE_DIR).glob("*.parquet"))
-    print(f"找到 {len(files)} 个数据文件")
+    partitions = [p for p in Path(KLINE_DIR).glob("year=*") if p.is_dir()]
+    files = list(Path(KLINE_DIR).glob("year=*/*.parquet"))
+    print(f"找到 {len(partitions)} 个年份分区, {len(files)} 个数据文件")
 
     if len(files) == 0:
         print("没有找到任何数据文件")
@@ -165,13 +227,15 @@ def verify_all_files():
     total_records = 0
     file_sizes = []
 
-    for file_path in files:
-        try:
-            df = pd.read_parquet(file_path)
-            total_records += len(df)
-            file_sizes.append(os.path.getsize(file_path) / 1024 / 1024)  # MB
-        except Exception as e:
-            print(f"警告: 无法读取文件 {file_path.name}: {str(e)}")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(read_file_stats, files))
+
+    for result in results:
+        if result is None:
+            continue
+        num_rows, size = result
+        total_records += num_rows
+        file_sizes.append(size)
 
     print(f"\n总记录数: {total_records:,}")
     print(f"平均每个文件记录数: {total_records / len(files):.0f}")
@@ -5,14 +5,23 @@
 """
 
 import os
-import pandas as pd
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 # 配置
 DATA_DIR = "data"
 KLINE_DIR = "data/kline_5m"
 STOCK_LIST_FILE = "data/stock_list.parquet"
+MAX_WORKERS = 16  # 并发读取文件元数据的线程数
+FOOTER_READ_SIZE = 64 * 1024  # 读取文件尾部的字节数，通常足以一次读入完整的footer
 
 
 def verify_stock_list():
@@ -76,12 +85,14 @@ def verify_kline_data(symbol: str = "000001"):
         print(f"\n缺失值统计:")
         print(missing_values)
 
-        # 检查价格数据合理性
-        invalid_prices = df[(df['high'] < df['low']) |
-                           (df['high'] < df['open']) |
-                           (df['high'] < df['close']) |
-                           (df['low'] > df['open']) |
-                           (df['low'] > df['close'])]
+        # 检查价格数据合理性：high 不低于 max(open, close)，low 不高于 min(open, close)，
+        # high 不低于 low；一次取出OHLC数组做向量化比较
+        ohlc = df[['open', 'high', 'low', 'close']].to_numpy(dtype=np.float64)
+        high, low = ohlc[:, 1], ohlc[:, 2]
+        body_high = np.fmax(ohlc[:, 0], ohlc[:, 3])  # fmax/fmin 忽略单边缺失值
+        body_low = np.fmin(ohlc[:, 0], ohlc[:, 3])
+        invalid_rows = np.flatnonzero((high < body_high) | (low > body_low) | (high < low))
+        invalid_prices = df.iloc[invalid_rows]
 
         if len(invalid_prices) > 0:
             print(f"\n警告: 发现 {len(invalid_prices)} 条价格数据不合理的记录")
@@ -127,13 +138,17 @@ def verify_kline_data(symbol: str = "000001"):
         print("-" * 60)
 
         if 'adj_factor' in df.columns:
-            df['adj_close'] = df['close'] * df['adj_factor']
-            df['returns'] = df['adj_close'].pct_change()
-
-            print(f"平均收益率: {df['returns'].mean():.6f}")
-            print(f"收益率标准差: {df['returns'].std():.6f}")
-            print(f"最大收益率: {df['returns'].max():.6f}")
-            print(f"最小收益率: {df['returns'].min():.6f}")
+            # 直接由相邻两根K线的 close*adj_factor 计算收益率，不生成中间列
+            adj_close = df['close'].to_numpy(dtype=np.float64) * df['adj_factor'].to_numpy(dtype=np.float64)
+            returns = adj_close[1:] / adj_close[:-1] - 1.0
+
+            if returns.size:
+                print(f"平均收益率: {np.nanmean(returns):.6f}")
+                print(f"收益率标准差: {np.nanstd(returns, ddof=1):.6f}")
+                print(f"最大收益率: {np.nanmax(returns):.6f}")
+                print(f"最小收益率: {np.nanmin(returns):.6f}")
+            else:
+                print("数据不足两条，无法计算收益率")
 
         return True
 
@@ -144,6 +159,35 @@ def verify_kline_data(symbol: str = "000001"):
         return False
 
 
+def read_parquet_metadata(file_path: Path) -> Tuple[pq.FileMetaData, int]:
+    """读取Parquet文件尾部的元数据，返回 (元数据, 文件字节数)
+
+    用一次 pread 读入文件末尾 FOOTER_READ_SIZE 字节并在内存中解析，footer 更大时再补读一次；
+    每个文件只有 open/fstat/pread/close 几次系统调用。
+    """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        tail = os.pread(fd, min(size, FOOTER_READ_SIZE), max(0, size - FOOTER_READ_SIZE))
+        # 文件末尾 8 字节为 footer 长度（小端 uint32）和魔数 "PAR1"
+        footer_size = struct.unpack('<I', tail[-8:-4])[0] + 8
+        if footer_size > len(tail):
+            tail = os.pread(fd, footer_size, size - footer_size)
+    finally:
+        os.close(fd)
+    return pq.read_metadata(pa.BufferReader(tail[-footer_size:])), size
+
+
+def read_file_stats(file_path: Path) -> Optional[Tuple[int, float]]:
+    """只读取Parquet文件尾部元数据，返回 (记录数, 文件大小MB)，读取失败返回 None"""
+    try:
+        metadata, size = read_parquet_metadata(file_path)
+        return metadata.num_rows, size / 1024 / 1024
+    except Exception as e:
+        print(f"警告: 无法读取文件 {file_path}: {str(e)}")
+        return None
+
+
 def verify_all_files():
     """验证所有下载的文件"""
     print("\n" + "=" * 60)
@@ -165,13 +209,15 @@ def verify_all_files():
     total_records = 0
     file_sizes = []
 
-    for file_path in files:
-        try:
-            df = pd.read_parquet(file_path)
-            total_records += len(df)
-            file_sizes.append(os.path.getsize(file_path) / 1024 / 1024)  # MB
-        except Exception as e:
-            print(f"警告: 无法读取文件 {file_path.name}: {str(e)}")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(read_file_stats, files))
+
+    for result in results:
+        if result is None:
+            continue
+        num_rows, size = result
+        total_records += num_rows
+        file_sizes.append(size)
 
     print(f"\n总记录数: {total_records:,}")
     print(f"平均每个文件记录数: {total_records / len(files):.0f}")